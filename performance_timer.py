@@ -1,8 +1,37 @@
-import time
-import csv
+import io
 import os
-from datetime import datetime
-from typing import Optional, List, Dict
+import time
+import re
+import atexit
+import shutil
+import sqlite3
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from itertools import islice
+from urllib.request import pathname2url
+from typing import Any, Iterable, NamedTuple, Optional, List, Dict, Tuple
+
+
+# csvモジュール（excel方言）と同じ条件で、クォートが必要な文字を含むか判定
+_needs_quote = re.compile(r'[",\r\n]').search
+
+
+def _q(value: str) -> str:
+    """必要な場合のみCSVのフィールドをダブルクォートで囲む"""
+    if _needs_quote(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class Record(NamedTuple):
+    """1回分の計測結果"""
+    start_time: float  # 開始時刻（UNIXタイムスタンプ）
+    end_time: float  # 終了時刻（UNIXタイムスタンプ）
+    duration: float  # 所要時間（秒）
+    operation: str  # 操作
+    iteration: Optional[int]  # 回数
 
 
 class PerformanceTimer:
@@ -16,41 +45,186 @@ class PerformanceTimer:
     timer.stop()
     """
     
-    def __init__(self, csv_filename: str = "performance_log.csv"):
+    # CSVに出力するタイムスタンプの書式（0.1秒の桁は別途付加）
+    _FMT = '%Y-%m-%d %H:%M:%S'
+    
+    # 直前に変換した秒とその書式化結果（同じ秒の記録が続く場合にstrftimeを省略する）
+    # 書き込みスレッドと呼び出し元の両方から使われるため、1つのタプルとしてまとめて差し替える
+    _last_sec_prefix = (-1, "")
+    
+    # CSVのヘッダー行
+    _HEADER = '開始時刻,終了時刻,所要時間(秒),操作,回数\r\n'.encode('utf-8')
+    
+    # sqliteバックエンドのテーブル定義（時刻はUNIXタイムスタンプのまま保存する）
+    _SQLITE_SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS perf ("
+        "start_time REAL, end_time REAL, duration REAL, operation TEXT, iteration INTEGER)"
+    )
+    _SQLITE_INSERT = "INSERT INTO perf VALUES (?, ?, ?, ?, ?)"
+    
+    def __init__(self, csv_filename: str = "performance_log.csv", batch_size: int = 50,
+                 keep_in_memory: bool = False, backend: str = "csv",
+                 db_filename: str = "performance_log.db"):
         """
         パフォーマンスタイマーの初期化
         
         Args:
             csv_filename (str): 出力するCSVファイル名（デフォルト: performance_log.csv）
+            batch_size (int): この件数（1以上）の記録が溜まるごとにバックグラウンドでCSVへ書き込む（デフォルト: 50）
+            keep_in_memory (bool): CSVへの出力に加えて記録をメモリ上にも保持するか（デフォルト: False）
+            backend (str): 記録の出力先。"csv" または "sqlite"（デフォルト: "csv"）
+            db_filename (str): backend="sqlite"の場合に出力するデータベースファイル名（デフォルト: performance_log.db）
         """
+        if backend not in ("csv", "sqlite"):
+            raise ValueError(f"未対応のbackendです: {backend}")
+        if batch_size < 1:
+            raise ValueError(f"batch_sizeには1以上を指定してください: {batch_size}")
         self.csv_filename = csv_filename
+        self.db_filename = db_filename
+        self.backend = backend
+        self.batch_size = batch_size
+        self.keep_in_memory = keep_in_memory
+        self._log = logging.getLogger(__name__)
         self.start_time: Optional[float] = None
-        self.end_time: Optional[float] = None
+        self._perf_start: Optional[int] = None
         self.operation: Optional[str] = None
         self.iteration: Optional[int] = None
-        self.records: List[Dict[str, str]] = []
+        self.records: List[Record] = []
+        self._closed = False
+        # 書き込みスレッドで発生した例外（次のflush()などで呼び出し元に送出する）
+        self._error: Optional[BaseException] = None
+        
+        # 記録は事前に確保したbatch_size件のバッファに詰め、満杯になったら予備のバッファと
+        # 入れ替えて書き込みスレッドに渡す（ダブルバッファ）。書き込み済みのバッファは_freeに戻る
+        self._buf: List[Optional[Record]] = [None] * batch_size
+        self._idx = 0
+        self._free: "queue.Queue[List[Optional[Record]]]" = queue.Queue()
+        self._free.put([None] * batch_size)
+        self._queue: "queue.Queue[Optional[Tuple[List[Optional[Record]], int]]]" = queue.Queue()
         
-        # CSVファイルが存在しない場合はヘッダーを作成
-        if not os.path.exists(csv_filename):
-            self._create_csv_header()
+        if backend == "sqlite":
+            # 書き込みは書き込みスレッドで行うため、作成したスレッド以外からの利用を許可する
+            self._conn = sqlite3.connect(db_filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(self._SQLITE_SCHEMA)
+            self._conn.commit()
+        else:
+            # CSVファイルはタイマーの生存期間中開いたままにする
+            # テキストモードの書き込みごとのエンコードを避け、バイナリで開いてまとめてUTF-8に変換する
+            self._raw = open(csv_filename, 'ab', buffering=0)
+            self._fh = io.BufferedWriter(self._raw, 65536)
+            
+            # 空のファイル（新規作成を含む）の場合のみヘッダーを書き込む
+            if self._fh.tell() == 0:
+                self._fh.write(self._HEADER)
+                self._fh.flush()
+        
+        # 書き込みスレッドは最初のバッファを渡す時点で起動する（記録しないタイマーではスレッドを作らない）
+        self._thread: Optional[threading.Thread] = None
+        atexit.register(self.close)
+    
+    def __enter__(self):
+        return self
     
-    def _create_csv_header(self):
-        """CSVファイルのヘッダーを作成"""
-        with open(self.csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['開始時刻', '終了時刻', '所要時間(秒)', '操作', '回数'])
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
-    def _round_to_tenth(self, timestamp: float) -> float:
+    def _write_rows(self, records: Iterable[Record]):
         """
-        タイムスタンプを0.1秒単位に丸める
+        記録をCSVファイル（またはデータベース）に書き込む
         
         Args:
-            timestamp (float): 元のタイムスタンプ
-            
-        Returns:
-            float: 0.1秒単位に丸められたタイムスタンプ
+            records (Iterable[Record]): 記録データ
+        """
+        if self.backend == "sqlite":
+            # 1バッチを1トランザクションでまとめて挿入する
+            with self._conn:
+                self._conn.executemany(self._SQLITE_INSERT, records)
+            return
+        
+        # 文字列への変換は書き込み直前にまとめて行う
+        self._fh.write(self._format_rows(records).encode('utf-8'))
+        self._fh.flush()
+    
+    def _writer_loop(self):
+        """書き込みスレッドの本体。受け取ったバッファを書き込み、空きバッファとして戻す"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            buf, count = item
+            try:
+                self._write_rows(islice(buf, count))
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._free.put(buf)
+                self._queue.task_done()
+    
+    def _submit(self):
+        """書き込み中のバッファを書き込みスレッドに渡し、空きバッファに切り替える"""
+        if self._closed:
+            raise ValueError("close()済みのタイマーには記録できません")
+        if self._thread is None:
+            thread = threading.Thread(target=self._writer_loop, name="PerformanceTimerWriter",
+                                      daemon=True)
+            thread.start()
+            # 起動に成功した場合のみ保持する（close()が未起動のスレッドをjoinしないように）
+            self._thread = thread
+        self._queue.put((self._buf, self._idx))
+        # 書き込みスレッドが前のバッファを書き終えていない場合のみここで待つ
+        self._buf = self._free.get()
+        self._idx = 0
+        self._raise_writer_error()
+    
+    def _raise_writer_error(self):
+        """書き込みスレッドで例外が発生していれば、呼び出し元で送出する"""
+        error = self._error
+        if error is not None:
+            self._error = None
+            raise error
+    
+    def flush(self):
+        """未書き込みの記録をCSVファイル（またはデータベース）に書き込み、完了まで待つ"""
+        if self._closed:
+            return
+        if self._thread is None:
+            # 書き込みスレッドが未起動なら呼び出し元のスレッドで直接書き込む
+            # （インタプリタ終了時のatexitからはスレッドを起動できないため）
+            if self._idx:
+                try:
+                    self._write_rows(islice(self._buf, self._idx))
+                finally:
+                    self._idx = 0
+            return
+        if self._idx:
+            self._submit()
+        self._queue.join()
+        self._raise_writer_error()
+    
+    def close(self):
+        """
+        未書き込みの記録を書き込んでCSVファイル（またはデータベース）を閉じ、書き込みスレッドを終了する
+        
+        複数回呼び出しても安全。呼び忘れた場合もプログラム終了時に自動で呼ばれるが、
+        それまではファイルと書き込みスレッドが残るため、使い終わったら呼び出すかwith文を使うこと。
         """
-        return round(timestamp, 1)
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            # 書き込みに失敗した場合もスレッドとファイルは確実に後始末する
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+            if self.backend == "sqlite":
+                self._conn.close()
+            else:
+                self._fh.close()
+            self._closed = True
+            atexit.unregister(self.close)
     
     def _format_timestamp(self, timestamp: float) -> str:
         """
@@ -62,10 +236,34 @@ class PerformanceTimer:
         Returns:
             str: YYYY-MM-DD HH:MM:SS.S 形式の文字列（0.1秒単位）
         """
-        dt = datetime.fromtimestamp(timestamp)
-        # 0.1秒単位で丸められたミリ秒部分を計算
-        milliseconds = int((timestamp % 1) * 10)  # 0.1秒単位
-        return dt.strftime('%Y-%m-%d %H:%M:%S') + f'.{milliseconds}'
+        # datetimeオブジェクトを作らず、元のタイムスタンプを0.1秒単位の整数にしてから
+        # 秒と0.1秒の桁に分ける（丸めを挟まないため桁が「10」になることはない）
+        sec, tenth = divmod(int(timestamp * 10), 10)
+        last_sec, prefix = self._last_sec_prefix
+        if sec != last_sec:
+            prefix = time.strftime(self._FMT, time.localtime(sec))
+            self._last_sec_prefix = (sec, prefix)
+        return f"{prefix}.{tenth}"
+    
+    def _format_rows(self, records: Iterable[Record]) -> str:
+        """
+        記録をCSVの行に変換
+        
+        列構成が固定なので、csv.writerを使わず文字列を直接組み立てる。
+        クォートが必要になり得るのは操作の列のみ。
+        
+        Args:
+            records (Iterable[Record]): 記録データ
+            
+        Returns:
+            str: 改行（CRLF）区切りのCSV文字列（末尾の改行を含む）
+        """
+        fmt = self._format_timestamp
+        # 所要時間は表示用に0.1秒単位に丸める
+        return ''.join(
+            f'{fmt(s)},{fmt(e)},{round(d, 1)},{_q(op)},{"" if it is None else it}\r\n'
+            for s, e, d, op, it in records
+        )
     
     def start(self, operation: str = "", iteration: Optional[int] = None):
         """
@@ -75,76 +273,132 @@ class PerformanceTimer:
             operation (str): 操作
             iteration (Optional[int]): 操作の回数（1, 2, 3...）。指定すると説明に含められます
         """
-        self.start_time = self._round_to_tenth(time.time())
+        # 表示用の壁時計時刻と、所要時間計測用の高分解能カウンタを別々に取得
+        self.start_time = time.time()
+        self._perf_start = time.perf_counter_ns()
         self.iteration = iteration
         self.operation = operation
-            
-        self.end_time = None
-        formatted_time = self._format_timestamp(self.start_time)
-        print(f"タイマー開始: {self.operation} (時刻: {formatted_time})")
+        
+        # DEBUGが無効な場合はメッセージの組み立て自体を行わない
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug(f"タイマー開始: {self.operation} (時刻: {self._format_timestamp(self.start_time)})")
     
     def stop(self) -> Optional[float]:
         """
         タイマーを停止し、所要時間を計算
         
         Returns:
-            Optional[float]: 所要時間（秒）、start()が呼ばれていない場合はNone
+            Optional[float]: 所要時間（秒、丸めなし）、start()が呼ばれていない場合はNone
         """
-        if self.start_time is None:
-            print("警告: start()が呼ばれていません")
+        perf_end = time.perf_counter_ns()
+        start_time = self.start_time
+        if start_time is None:
+            self._log.warning("start()が呼ばれていません")
             return None
+        operation = self.operation
         
-        self.end_time = self._round_to_tenth(time.time())
-        duration = self._round_to_tenth(self.end_time - self.start_time)
+        try:
+            # 所要時間はperf_counter_nsの差分から求め、丸めるのは表示用の値のみ
+            duration = self._record(start_time, perf_end - self._perf_start, operation, self.iteration)
+        finally:
+            # リセット（_perf_startはstart_timeがNoneの間は参照されないため残したままにする）
+            # 以前のバッチの書き込みエラーが送出された場合も、古い開始時刻で再度記録されないようにする
+            self.start_time = None
+            self.operation = None
+            self.iteration = None
         
-        # 記録を作成
-        record = {
-            'start_time': self._format_timestamp(self.start_time),
-            'end_time': self._format_timestamp(self.end_time),
-            'duration': str(duration),
-            'operation': self.operation or "",
-            'iteration': str(self.iteration) if self.iteration is not None else ""
-        }
-        self.records.append(record)
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug(f"タイマー停止: {operation} (所要時間: {round(duration, 1)}秒)")
         
-        print(f"タイマー停止: {self.operation} (所要時間: {duration}秒)")
+        return duration
+    
+    @contextmanager
+    def measure(self, operation: str = "", iteration: Optional[int] = None):
+        """
+        withブロックの実行時間を計測するコンテキストマネージャ
         
-        # CSVに即座に出力
-        self._write_to_csv(record)
+        使用方法:
+        with timer.measure("画面の保存"):
+            # ... 操作実行 ...
         
-        # リセット
-        self.start_time = None
-        self.end_time = None
-        self.operation = None
-        self.iteration = None
+        Args:
+            operation (str): 操作
+            iteration (Optional[int]): 操作の回数（1, 2, 3...）
+        """
+        # start()/stop()と違いインスタンス属性を書き換えず、ローカル変数だけで計測する
+        wall = time.time()
+        t0 = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._record(wall, time.perf_counter_ns() - t0, operation, iteration)
+    
+    def _record(self, wall_start: float, duration_ns: int,
+                operation: Optional[str], iteration: Optional[int]) -> float:
+        """
+        計測結果を記録し、batch_size件溜まったら書き込みスレッドに渡す
         
+        Args:
+            wall_start (float): 開始時のUNIXタイムスタンプ
+            duration_ns (int): 所要時間（ナノ秒）
+            operation (Optional[str]): 操作
+            iteration (Optional[int]): 操作の回数
+            
+        Returns:
+            float: 所要時間（秒）
+        """
+        # close()後の記録はバッファに溜まったまま書き込まれなくなるため、その場で拒否する
+        if self._closed:
+            raise ValueError("close()済みのタイマーには記録できません")
+        duration = duration_ns / 1e9
+        # 記録は数値のまま保持し、文字列への変換はCSV書き込み時に行う
+        # 操作は文字列として保持する（csv.writerを使っていた頃と同様に数値なども受け付ける）
+        record = Record(wall_start, wall_start + duration, duration,
+                        str(operation) if operation else "", iteration)
+        # 記録はCSVに残るため、メモリ上への保持は指定された場合のみ行う
+        if self.keep_in_memory:
+            self.records.append(record)
+        buf = self._buf
+        idx = self._idx
+        buf[idx] = record
+        idx += 1
+        self._idx = idx
+        if idx == len(buf):
+            self._submit()
         return duration
     
-    def _write_to_csv(self, record: Dict[str, str]):
+    def log_many(self, rows: Iterable[Tuple[float, float, float, str, Optional[int]]]):
         """
-        記録をCSVファイルに書き込み
+        複数の計測結果をまとめて記録（スクリプトからの一括登録や記録の再生向け）
+        
+        start()/stop()を繰り返す代わりに、すべての行を1回の書き込みでCSVに出力する。
         
         Args:
-            record (Dict[str, str]): 記録データ
+            rows (Iterable[Tuple[float, float, float, str, Optional[int]]]):
+                Recordまたは(開始時刻, 終了時刻, 所要時間(秒), 操作, 回数)のタプル。時刻はUNIXタイムスタンプ
         """
-        with open(self.csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                record['start_time'],
-                record['end_time'],
-                record['duration'],
-                record['operation'],
-                record['iteration']
-            ])
+        # 操作は_record()と同様に文字列へそろえる
+        rows = [Record(s, e, d, str(op) if op else "", it) for s, e, d, op, it in rows]
+        # 書き込み待ちの記録を先に出力し、CSV上の順序を保つ
+        # flush()の後は書き込みスレッドが待機状態になるため、ここで直接書き込んでよい
+        self.flush()
+        if self._closed:
+            raise ValueError("close()済みのタイマーには記録できません")
+        self._write_rows(rows)
+        # 書き込みに成功した場合のみメモリ上に保持し、CSVとの食い違いを防ぐ
+        if self.keep_in_memory:
+            self.records.extend(rows)
     
-    def get_all_records(self) -> List[Dict[str, str]]:
+    def get_all_records(self) -> List[Dict[str, Any]]:
         """
         すべての記録を取得
         
         Returns:
-            List[Dict[str, str]]: 記録のリスト
+            List[Dict[str, Any]]: 記録のリスト（時刻はUNIXタイムスタンプ、所要時間は秒）
         """
-        return self.records.copy()
+        if not self.keep_in_memory:
+            self._log.warning("keep_in_memory=Falseのため記録はメモリ上に保持されていません")
+        return [record._asdict() for record in self.records]
     
     def clear_records(self):
         """メモリ上の記録をクリア"""
@@ -152,35 +406,54 @@ class PerformanceTimer:
     
     def export_records(self, filename: str = None):
         """
-        記録を別ファイルにエクスポート
+        CSVファイルを別ファイルにエクスポート
+        
+        書き込み待ちの記録をCSVに書き込んだうえで、CSVファイルをそのままコピーする。
+        そのため以前のセッションでCSVに追記された記録も含まれ、clear_records()の影響は受けない。
+        backend="sqlite"の場合はデータベースの全記録を同じ形式のCSVとして出力する
+        （close()後はデータベースを読み取り専用で開き直すため、CSVと同様にエクスポートできる）。
+        一時ファイルに書き出してから置き換えるため、途中で失敗しても不完全なファイルは残らない。
         
         Args:
             filename (str): エクスポート先ファイル名（指定しない場合は現在時刻で自動生成）
         """
         if not filename:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"performance_export_{timestamp}.csv"
+            filename = f"performance_export_{time.strftime('%Y%m%d_%H%M%S')}.csv"
         
-        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['開始時刻', '終了時刻', '所要時間(秒)', '操作', '回数'])
-            
-            for record in self.records:
-                writer.writerow([
-                    record['start_time'],
-                    record['end_time'],
-                    record['duration'],
-                    record['operation'],
-                    record['iteration']
-                ])
-        
-        print(f"記録を {filename} にエクスポートしました")
+        self.flush()
+        tmp = filename + '.tmp'
+        try:
+            if self.backend == "sqlite":
+                if self._closed:
+                    uri = f"file:{pathname2url(os.path.abspath(self.db_filename))}?mode=ro"
+                    conn = sqlite3.connect(uri, uri=True)
+                else:
+                    conn = self._conn
+                try:
+                    rows = conn.execute("SELECT * FROM perf ORDER BY rowid")
+                    with open(tmp, 'wb') as f:
+                        f.write(self._HEADER)
+                        f.write(self._format_rows(rows).encode('utf-8'))
+                finally:
+                    if conn is not self._conn:
+                        conn.close()
+            else:
+                shutil.copyfile(self.csv_filename, tmp)
+            os.replace(tmp, filename)
+        except BaseException:
+            # 失敗した場合は書きかけの一時ファイルを残さない
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        
+        self._log.info(f"記録を {filename} にエクスポートしました")
 
 
 # 使用例
 if __name__ == "__main__":
     # 使用例
-    timer = PerformanceTimer()
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    timer = PerformanceTimer(keep_in_memory=True)
     
     # 基本的なテスト実行
     timer.start(operation="画面の保存")
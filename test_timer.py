@@ -5,6 +5,11 @@
 """
 
 from performance_timer import PerformanceTimer
+import csv
+import math
+import os
+import subprocess
+import sys
 import time
 
 
@@ -37,7 +42,7 @@ def test_multiple_operations():
     """複数操作の連続テスト"""
     print("\n=== 複数操作の連続テスト ===")
     
-    timer = PerformanceTimer("test_multiple.csv")
+    timer = PerformanceTimer("test_multiple.csv", keep_in_memory=True)
     
     operations = [
         ("画面の保存", 1.2),
@@ -92,26 +97,360 @@ def test_csv_output():
     print("CSVファイルが正常に作成されました")
 
 
-def main():
-    """メイン関数"""
-    print("パフォーマンスタイマーモジュールのテストを開始します\n")
+def _remove(*filenames):
+    """前回の実行で作成されたファイルを削除（行数を検証するテスト用）"""
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _read_rows(filename):
+    """CSVファイルのヘッダーを除いた行を取得"""
+    with open(filename, newline='', encoding="utf-8") as f:
+        return list(csv.reader(f))[1:]
+
+
+def test_batch_write():
+    """まとめ書きのテスト"""
+    print("\n=== まとめ書きテスト ===")
+    
+    _remove("test_batch.csv")
+    timer = PerformanceTimer("test_batch.csv", batch_size=3)
+    
+    for i in range(1, 5):
+        timer.start(operation="まとめ書きテスト操作", iteration=i)
+        timer.stop()
+    
+    # batch_size件分は書き込みスレッドに渡され、残りの1件は書き込み待ち
+    timer.flush()
+    assert len(_read_rows("test_batch.csv")) == 4
+    
+    timer.start(operation="まとめ書きテスト操作", iteration=5)
+    timer.stop()
+    timer.close()
+    rows = _read_rows("test_batch.csv")
+    assert [row[4] for row in rows] == ["1", "2", "3", "4", "5"], rows
+    print(f"close後の記録数: {len(rows)}")
+
+
+def test_writer_error():
+    """書き込みスレッドで発生したエラーの送出のテスト"""
+    print("\n=== 書き込みエラーテスト ===")
+    
+    timer = PerformanceTimer("test_writer_error.csv", batch_size=2)
+    
+    def fail(records):
+        raise OSError("書き込み失敗")
+    timer._write_rows = fail
+    
+    # 書き込みスレッドで失敗したバッチのエラーはflush()で送出される
+    for i in range(1, 3):
+        timer.start(operation="書き込みエラーテスト操作", iteration=i)
+        timer.stop()
+    try:
+        timer.flush()
+        raise AssertionError("flush()で書き込みエラーが送出されていません")
+    except OSError:
+        pass
+    
+    # close()時の書き込みで失敗した場合もエラーが送出され、タイマーは閉じられる
+    timer.start(operation="書き込みエラーテスト操作", iteration=3)
+    timer.stop()
+    try:
+        timer.close()
+        raise AssertionError("close()で書き込みエラーが送出されていません")
+    except OSError:
+        pass
+    assert timer._closed and not timer._thread.is_alive()
+    print("書き込みエラーがflush()とclose()で送出されました")
+
+
+def test_record_after_close():
+    """close()後の記録のテスト"""
+    print("\n=== close()後の記録テスト ===")
+    
+    timer = PerformanceTimer("test_after_close.csv")
+    timer.close()
     
+    timer.start(operation="close後の操作")
     try:
-        test_basic_functionality()
-        test_multiple_operations()
-        test_error_handling()
-        test_csv_output()
+        timer.stop()
+        raise AssertionError("close()後のstop()がエラーになっていません")
+    except ValueError:
+        pass
+    try:
+        with timer.measure(operation="close後の操作"):
+            pass
+        raise AssertionError("close()後のmeasure()がエラーになっていません")
+    except ValueError:
+        pass
+    try:
+        timer.log_many([(0.0, 1.0, 1.0, "close後の操作", None)])
+        raise AssertionError("close()後のlog_many()がエラーになっていません")
+    except ValueError:
+        pass
+    print("close()後の記録はValueErrorになりました")
+
+
+def test_log_many():
+    """log_many()による一括記録のテスト"""
+    print("\n=== log_many()テスト ===")
+    
+    _remove("test_log_many.csv")
+    with PerformanceTimer("test_log_many.csv", keep_in_memory=True) as timer:
+        timer.start(operation="stopの操作", iteration=1)
+        timer.stop()
+        now = time.time()
+        # 操作がNoneや数値でも文字列として記録される
+        timer.log_many([
+            (now, now + 1.0, 1.0, None, None),
+            (now, now + 2.0, 2.0, 123, 2),
+        ])
+        timer.start(operation="stopの操作", iteration=3)
+        timer.stop()
         
-        print("\n=== すべてのテストが完了しました ===")
-        print("生成されたCSVファイルを確認してください:")
-        print("- test_basic.csv")
-        print("- test_multiple.csv")
-        print("- test_error.csv")
-        print("- test_csv_output.csv")
-        print("- test_export.csv")
+        # 書き込みに失敗した場合はメモリ上の記録を変更しない
+        # （書き込み待ちの記録は先に書き込み、log_many()自体の書き込みだけを失敗させる）
+        timer.flush()
+        records_before = list(timer.records)
         
-    except Exception as e:
-        print(f"テスト中にエラーが発生しました: {e}")
+        def fail(records):
+            raise OSError("書き込み失敗")
+        timer._write_rows = fail
+        try:
+            timer.log_many([(now, now + 1.0, 1.0, "失敗する操作", None)])
+            raise AssertionError("書き込みエラーが送出されていません")
+        except OSError:
+            pass
+        assert timer.records == records_before
+        del timer._write_rows
+    
+    rows = _read_rows("test_log_many.csv")
+    assert [(row[3], row[4]) for row in rows] == [
+        ("stopの操作", "1"), ("", ""), ("123", "2"), ("stopの操作", "3"),
+    ], rows
+    assert [record.operation for record in records_before] == ["stopの操作", "", "123", "stopの操作"]
+    print(f"log_many()を含む記録数: {len(rows)}")
+
+
+def test_measure():
+    """コンテキストマネージャによる計測のテスト"""
+    print("\n=== measure()テスト ===")
+    
+    with PerformanceTimer("test_measure.csv", keep_in_memory=True) as timer:
+        with timer.measure(operation="measureテスト操作", iteration=1):
+            time.sleep(0.4)
+        
+        records = timer.get_all_records()
+        assert len(records) == 1
+        assert records[0]['operation'] == "measureテスト操作" and records[0]['iteration'] == 1
+        assert records[0]['duration'] >= 0.4
+        print(f"measureテスト操作: {records[0]['duration']}秒")
+
+
+def test_keep_in_memory():
+    """メモリ上への記録保持の有無のテスト"""
+    print("\n=== keep_in_memoryテスト ===")
+    
+    with PerformanceTimer("test_keep_in_memory.csv") as timer:
+        with timer.measure(operation="保持しない操作"):
+            pass
+        assert len(timer.records) == 0
+        print(f"keep_in_memory=False の記録数: {len(timer.records)}")
+    
+    with PerformanceTimer("test_keep_in_memory.csv", keep_in_memory=True) as timer:
+        with timer.measure(operation="保持する操作"):
+            pass
+        assert len(timer.records) == 1
+        print(f"keep_in_memory=True の記録数: {len(timer.records)}")
+
+
+def test_sqlite_backend():
+    """SQLiteバックエンドのテスト"""
+    print("\n=== SQLiteバックエンドテスト ===")
+    
+    _remove("test_sqlite.db")
+    with PerformanceTimer(backend="sqlite", db_filename="test_sqlite.db") as timer:
+        for i in range(1, 4):
+            with timer.measure(operation="SQLiteテスト操作", iteration=i):
+                time.sleep(0.1)
+        timer.export_records("test_sqlite_export.csv")
+    
+    rows = _read_rows("test_sqlite_export.csv")
+    assert [(row[3], row[4]) for row in rows] == [("SQLiteテスト操作", str(i)) for i in range(1, 4)], rows
+    print("SQLiteデータベースとエクスポートCSVが正常に作成されました")
+
+
+def test_export_after_close():
+    """close()後のエクスポートのテスト（CSV・SQLiteとも同じ動作）"""
+    print("\n=== close()後のエクスポートテスト ===")
+    
+    _remove("test_export_closed.csv", "test_export_closed.db")
+    for backend in ("csv", "sqlite"):
+        export_filename = f"test_export_closed_{backend}.csv"
+        timer = PerformanceTimer("test_export_closed.csv", backend=backend,
+                                 db_filename="test_export_closed.db")
+        with timer.measure(operation=f"{backend}の操作"):
+            pass
+        timer.close()
+        timer.export_records(export_filename)
+        rows = _read_rows(export_filename)
+        assert [row[3] for row in rows] == [f"{backend}の操作"], rows
+    print("close()後もCSV・SQLiteの両方でエクスポートできました")
+
+
+def test_export_failure():
+    """エクスポート失敗時に一時ファイルが残らないことのテスト"""
+    print("\n=== エクスポート失敗テスト ===")
+    
+    _remove("test_export_failure.db", "test_export_failure.csv", "test_export_failure.csv.tmp")
+    with PerformanceTimer(backend="sqlite", db_filename="test_export_failure.db") as timer:
+        # 時刻として扱えない値を記録し、ヘッダーの書き込み後のCSV変換で失敗させる
+        timer.log_many([("不正な時刻", 1.0, 1.0, "不正な記録", None)])
+        try:
+            timer.export_records("test_export_failure.csv")
+            raise AssertionError("エクスポートが失敗していません")
+        except ValueError:
+            pass
+    
+    assert not os.path.exists("test_export_failure.csv.tmp")
+    assert not os.path.exists("test_export_failure.csv")
+    print("エクスポート失敗時に一時ファイルは残りませんでした")
+
+
+def test_timestamp_format():
+    """タイムスタンプの0.1秒単位表示のテスト"""
+    print("\n=== タイムスタンプ表示テスト ===")
+    
+    with PerformanceTimer("test_timestamp.csv") as timer:
+        base = float(int(time.time()))
+        prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(base))
+        next_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(base + 1))
+        cases = [
+            (base, prefix + '.0'),
+            (base + 0.05, prefix + '.0'),
+            (base + 0.95, prefix + '.9'),
+            # 秒の境界の直前（1ulp手前）は切り捨てで同じ秒の.9になり、秒と0.1秒の桁が食い違わない
+            (math.nextafter(base + 1, 0), prefix + '.9'),
+            (base + 1, next_prefix + '.0'),
+        ]
+        for timestamp, expected in cases:
+            formatted = timer._format_timestamp(timestamp)
+            assert formatted == expected, (repr(timestamp), formatted, expected)
+            print(f"{timestamp!r}: {formatted}")
+
+
+def test_flush_at_exit():
+    """close()を呼ばずに終了した場合の書き込みのテスト"""
+    print("\n=== 終了時の書き込みテスト ===")
+    
+    if os.path.exists("test_exit.csv"):
+        os.remove("test_exit.csv")
+    # close()もwith文も使わず、batch_size未満の記録だけを残して終了する
+    script = (
+        "from performance_timer import PerformanceTimer\n"
+        "timer = PerformanceTimer('test_exit.csv')\n"
+        "for i in range(1, 4):\n"
+        "    timer.start(operation='終了時テスト操作', iteration=i)\n"
+        "    timer.stop()\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], env=env, check=True)
+    
+    with open("test_exit.csv", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 4, lines
+    print(f"終了時に書き込まれた行数: {len(lines) - 1}")
+
+
+def test_stop_after_writer_error():
+    """書き込みエラー送出後のstop()の状態リセットのテスト"""
+    print("\n=== 書き込みエラー後のstop()テスト ===")
+    
+    timer = PerformanceTimer("test_stop_error.csv", batch_size=1)
+    
+    def fail(records):
+        raise OSError("書き込み失敗")
+    timer._write_rows = fail
+    
+    # 1件目のバッチが書き込みスレッドで失敗し、2件目のstop()でそのエラーが送出される
+    timer.start(operation="エラー前の操作")
+    timer.stop()
+    timer._queue.join()
+    timer.start(operation="エラー送出時の操作")
+    try:
+        timer.stop()
+        raise AssertionError("書き込みエラーが送出されていません")
+    except OSError:
+        pass
+    assert timer.start_time is None and timer.operation is None
+    # start()なしのstop()は古い開始時刻で記録せず、警告してNoneを返す
+    assert timer.stop() is None
+    
+    del timer._write_rows
+    try:
+        timer.close()
+    except OSError:
+        pass
+    print("エラー送出後もタイマーの状態がリセットされました")
+
+
+def main():
+    """メイン関数"""
+    print("パフォーマンスタイマーモジュールのテストを開始します\n")
+    
+    tests = [
+        test_basic_functionality,
+        test_multiple_operations,
+        test_error_handling,
+        test_csv_output,
+        test_batch_write,
+        test_writer_error,
+        test_record_after_close,
+        test_log_many,
+        test_measure,
+        test_keep_in_memory,
+        test_sqlite_backend,
+        test_export_after_close,
+        test_export_failure,
+        test_timestamp_format,
+        test_flush_at_exit,
+        test_stop_after_writer_error,
+    ]
+    
+    # 1つのテストが失敗しても残りのテストは実行する
+    failures = []
+    for test in tests:
+        try:
+            test()
+        except Exception as e:
+            print(f"テスト中にエラーが発生しました ({test.__name__}): {e!r}")
+            failures.append(test.__name__)
+    
+    if failures:
+        print(f"\n=== {len(failures)}件のテストが失敗しました: {', '.join(failures)} ===")
+        sys.exit(1)
+    
+    print("\n=== すべてのテストが完了しました ===")
+    print("生成されたCSVファイルを確認してください:")
+    print("- test_basic.csv")
+    print("- test_multiple.csv")
+    print("- test_error.csv")
+    print("- test_csv_output.csv")
+    print("- test_export.csv")
+    print("- test_batch.csv")
+    print("- test_writer_error.csv")
+    print("- test_after_close.csv")
+    print("- test_log_many.csv")
+    print("- test_measure.csv")
+    print("- test_keep_in_memory.csv")
+    print("- test_sqlite.db")
+    print("- test_sqlite_export.csv")
+    print("- test_export_closed_csv.csv")
+    print("- test_export_closed_sqlite.csv")
+    print("- test_timestamp.csv")
+    print("- test_exit.csv")
+    print("- test_stop_error.csv")
 
 
 if __name__ == "__main__":